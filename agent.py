@@ -1,12 +1,28 @@
 import asyncio
 import logging
 from dotenv import load_dotenv
-from typing import Any
+from typing import Any, AsyncIterable, Final, Union
 from livekit import rtc
-from livekit.agents import AutoSubscribe, JobContext, WorkerOptions, cli, llm
+from livekit.agents import (
+    AutoSubscribe,
+    JobContext,
+    JobProcess,
+    WorkerOptions,
+    cli,
+    llm,
+)
 from livekit.agents.voice_assistant import VoiceAssistant
 from livekit.plugins import deepgram, openai, silero
 
+try:
+    import uvloop
+
+    # Installed at import time so the job subprocesses, which import this
+    # module, run on uvloop as well as the main worker process.
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:  # uvloop is not available on Windows
+    pass
+
 load_dotenv()
 
 logging.basicConfig(
@@ -15,24 +31,92 @@ logging.basicConfig(
 logger = logging.getLogger("livekit-agent")
 
 
+SYSTEM_PROMPT: Final[str] = """\
+You are a friendly and knowledgeable personal doctor AI. Your role is to have natural, human-like conversations with users who come to you with health concerns. When someone says something like “I feel sick” or “I have nausea,” your first instinct is to ask gentle, relevant follow-up questions to understand their symptoms better. You never rush to give advice — instead, you engage in a back-and-forth that helps the user feel heard, supported, and respected.
+
+Your main goal is to help the user understand what might be happening in their body, how serious it could be, and what next steps they should consider — all without acting like a licensed physician. Always make it clear that your advice is informational only, and not a substitute for professional medical care.
+
+Your conversation style should follow this general flow:
+
+Start with Empathy and Curiosity
+When a user mentions a symptom, respond with care and curiosity.
+Example:
+User: I feel nauseous.
+You: I'm sorry you're feeling that way. Can you tell me more? Are you also experiencing things like vomiting, dizziness, or stomach pain?
+
+Ask Smart Follow-Up Questions
+Try to get a sense of how long the symptom has lasted, how severe it is, and if it came with any other changes (fever, appetite loss, stress, etc.). Make it feel like a calm and thoughtful conversation — not a checklist.
+
+If a user asks you to look at them, check their skin, rash, swelling, or anything visual using the camera, you must call the capture_and_add_image function. This will capture an image from the video feed and add it to the conversation so you can refer to it when offering guidance. If asked to describe the image or what you see on the image, you must describe what's on the image use, you can use the image in the chat context to provide a description.
+After 2–3 exchanges, begin to offer insight
+Once you've gathered enough context, explain what the symptoms might suggest. Be clear that you’re not diagnosing — you're just offering helpful insight and next steps.
+You: Based on what you’ve told me, this might be related to something like a mild stomach virus or food intolerance. That said, if it gets worse or lasts more than a day or two, it’s a good idea to check in with a doctor in person.
+
+Provide General Treatment Advice and Home Care Tips
+Communicate in a calm, respectful, and supportive tone. Be non-judgmental and compassionate, especially when dealing with sensitive topics like mental health, chronic illness, or reproductive health.
+
+Safety and Caution
+You must never offer a definitive diagnosis or prescribe medication. Instead, you provide helpful, accurate information and advise users to consult a healthcare provider for confirmation and personalized care.
+
+Focus Areas
+General medicine (e.g., infections, chronic illnesses, injury care).
+Nutrition and dietary advice.
+Mental health support (e.g., anxiety, depression, sleep hygiene).
+Lifestyle coaching (e.g., exercise, smoking cessation).
+Pediatrics, geriatrics, and women's/men's health.
+Preventive medicine and regular screening guidelines.
+First aid and emergency response advice.
+Understanding lab results or imaging reports (with clear disclaimers).
+
+Encourage Medical Follow-Up If Needed
+If symptoms are concerning or could suggest something more serious, guide them gently:
+You: If you notice signs like high fever, blood in your vomit, or severe pain, please don’t wait — go see a doctor or urgent care right away.
+
+Privacy and Ethics
+Assume all interactions are private and treat them with confidentiality. You must not make assumptions based on race, gender, or personal identity, and you must always respect patient autonomy and dignity.
+
+When in Doubt
+If a question exceeds your capabilities or involves life-threatening symptoms (e.g., chest pain, difficulty breathing, sudden numbness), you must advise the user to seek immediate professional medical care."""
+
+GREETING: Final[str] = (
+    "Hello, I'm Dr. San. I'll be your personal doctor. How are you feeling today?"
+)
+
+_BASE_CTX = llm.ChatContext().append(role="system", text=SYSTEM_PROMPT)
+
+TTS_BATCH_TOKENS: Final[int] = 16
+TTS_BATCH_INTERVAL: Final[float] = 0.02
+
+
 class AssistantFnc(llm.FunctionContext):
     def __init__(self, chat_ctx: Any) -> None:
         super().__init__()
         self.room: Any = None
         self.latest_video_frame: Any = None
         self.chat_ctx: Any = chat_ctx
+        self._frame_ready = asyncio.Event()
+        self._video_pubs: list[rtc.RemoteTrackPublication] = []
+        self._pending_track: Any = None
+        self._frame_task: Any = None
+        self._captures_waiting = 0
 
     async def process_video_stream(self, track):
-        """Process video stream and store the first video frame."""
+        """Keep the latest video frame from the track until the stream ends."""
         logger.info(f"Starting to process video track: {track.sid}")
         video_stream = rtc.VideoStream(track)
         try:
             async for frame_event in video_stream:
                 self.latest_video_frame = frame_event.frame
-                logger.info(f"Received a frame from track {track.sid}")
-                break  # Process only the first frame
+                self._frame_ready.set()
         except Exception as e:
             logger.error(f"Error processing video stream: {e}")
+        finally:
+            # A newer task may already own the frame state if this one was replaced
+            if self._frame_task in (None, asyncio.current_task()):
+                self._frame_task = None
+                self.latest_video_frame = None
+                self._frame_ready.clear()
+            await video_stream.aclose()
 
     @llm.ai_callable()
     async def capture_and_add_image(self) -> str:
@@ -46,132 +130,212 @@ class AssistantFnc(llm.FunctionContext):
             logger.info("No video track available")
             return "No video track available"
 
+        self._captures_waiting += 1
         try:
-            await self._subscribe_and_capture_frame(video_publication)
-            if not self.latest_video_frame:
+            self._start_frame_task()
+            await self._wait_for_frame()
+            frame = self.latest_video_frame
+            if not frame:
                 logger.info("No video frame available")
                 return "No video frame available"
 
-            chat_image = llm.ChatImage(image=self.latest_video_frame)
+            chat_image = llm.ChatImage(image=frame)
             self.chat_ctx.append(images=[chat_image], role="user")
-            return f"Image captured and added to context. Dimensions: {self.latest_video_frame.width}x{self.latest_video_frame.height}"
+            return f"Image captured and added to context. Dimensions: {frame.width}x{frame.height}"
         except Exception as e:
             logger.error(f"Error in capture_and_add_image: {e}")
             return f"Error: {e}"
         finally:
-            self._unsubscribe_from_video(video_publication)
-            self.latest_video_frame = None
+            self._captures_waiting -= 1
 
     def _get_video_publication(self):
-        """Retrieve the first available video publication."""
+        """Retrieve the first known video publication."""
+        return self._video_pubs[0] if self._video_pubs else None
+
+    def _add_video_publication(self, publication):
+        """Track a video publication, subscribing to it if it is the first one."""
+        self._video_pubs.append(publication)
+        if len(self._video_pubs) == 1:
+            publication.set_subscribed(True)
+
+    def _remove_video_publications(self, publications):
+        """Stop tracking the given publications and subscribe to the next one."""
+        current = self._get_video_publication()
+        self._video_pubs = [p for p in self._video_pubs if p not in publications]
+        if self._video_pubs and current is not self._video_pubs[0]:
+            self._video_pubs[0].set_subscribed(True)
+
+    def scan_video_publications(self):
+        """Track the video publications that already exist in the room."""
         for participant in self.room.remote_participants.values():
             for publication in participant.track_publications.values():
                 if publication.kind == rtc.TrackKind.KIND_VIDEO:
-                    return publication
-        return None
-
-    async def _subscribe_and_capture_frame(self, publication):
-        """Subscribe to the video publication and wait for a frame to be processed."""
-        publication.set_subscribed(True)
-        for _ in range(10):  # Wait up to 5 seconds
-            if self.latest_video_frame:
+                    self._add_video_publication(publication)
+
+    def on_track_published(self, publication, participant):
+        """Track a newly published video track."""
+        if publication.kind == rtc.TrackKind.KIND_VIDEO:
+            self._add_video_publication(publication)
+
+    def on_track_unpublished(self, publication, participant):
+        """Forget a video track that went away."""
+        if publication.kind == rtc.TrackKind.KIND_VIDEO:
+            self._remove_video_publications([publication])
+
+    def on_participant_disconnected(self, participant):
+        """Forget the video tracks of a participant that left."""
+        self._remove_video_publications(
+            list(participant.track_publications.values())
+        )
+
+    def on_track_subscribed(self, track, publication, participant):
+        """Remember the video track; frames are only read once a capture asks for them."""
+        if track.kind == rtc.TrackKind.KIND_VIDEO:
+            self._stop_frame_task()
+            self._pending_track = track
+            if self._captures_waiting:
+                self._start_frame_task()
+
+    def on_track_unsubscribed(self, track, publication, participant):
+        """Stop reading frames from a track that is no longer subscribed."""
+        if track is self._pending_track:
+            self._stop_frame_task()
+            self._pending_track = None
+
+    def _start_frame_task(self):
+        """Start streaming frames from the subscribed video track if not running yet."""
+        if self._pending_track is not None and (
+            self._frame_task is None or self._frame_task.done()
+        ):
+            self._frame_task = asyncio.create_task(
+                self.process_video_stream(self._pending_track)
+            )
+
+    def _stop_frame_task(self):
+        """Cancel the frame streaming task, if any."""
+        if self._frame_task is not None:
+            self._frame_task.cancel()
+            self._frame_task = None
+        self.latest_video_frame = None
+        self._frame_ready.clear()
+
+    async def _wait_for_frame(self):
+        """Wait up to 5 seconds for the video stream to deliver a frame."""
+        try:
+            await asyncio.wait_for(self._frame_ready.wait(), timeout=5.0)
+        except asyncio.TimeoutError:
+            pass
+
+
+_END_OF_STREAM = object()
+
+
+async def _batch_tokens(tokens: AsyncIterable[str]) -> AsyncIterable[str]:
+    """Merge streamed LLM tokens into larger chunks before they reach TTS.
+
+    A chunk is flushed once it holds TTS_BATCH_TOKENS tokens or TTS_BATCH_INTERVAL
+    seconds after its first token, even if the LLM stream pauses in between.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def _read():
+        try:
+            async for token in tokens:
+                queue.put_nowait(token)
+        finally:
+            queue.put_nowait(_END_OF_STREAM)
+
+    reader = asyncio.create_task(_read())
+    get_task: Any = None
+    batch: list[str] = []
+    deadline = 0.0
+    try:
+        while True:
+            if get_task is None and not queue.empty():
+                token = queue.get_nowait()
+            else:
+                if get_task is None:
+                    get_task = asyncio.ensure_future(queue.get())
+                timeout = max(deadline - loop.time(), 0) if batch else None
+                await asyncio.wait([get_task], timeout=timeout)
+                if not get_task.done():
+                    yield "".join(batch)
+                    batch.clear()
+                    continue
+                token = get_task.result()
+                get_task = None
+
+            if token is _END_OF_STREAM:
                 break
-            await asyncio.sleep(0.5)
+            if not batch:
+                deadline = loop.time() + TTS_BATCH_INTERVAL
+            batch.append(token)
+            if len(batch) >= TTS_BATCH_TOKENS:
+                yield "".join(batch)
+                batch.clear()
+
+        if batch:
+            yield "".join(batch)
+        await reader  # re-raise errors from the LLM stream
+    finally:
+        reader.cancel()
+        if get_task is not None:
+            get_task.cancel()
+
 
-    def _unsubscribe_from_video(self, publication):
-        """Unsubscribe from the video publication."""
-        if publication:
-            publication.set_subscribed(False)
+def before_tts_cb(
+    assistant: VoiceAssistant, text: Union[str, AsyncIterable[str]]
+) -> Union[str, AsyncIterable[str]]:
+    """Batch streamed replies for TTS; plain strings pass through unchanged."""
+    if isinstance(text, str):
+        return text
+    return _batch_tokens(text)
+
+
+def prewarm(proc: JobProcess):
+    """Load the VAD model once per worker process and share it across jobs."""
+    proc.userdata["vad"] = silero.VAD.load()
 
 
 async def entrypoint(ctx: JobContext):
     """Main entry point for the voice assistant job."""
+    shutdown = asyncio.Event()
+    ctx.room.on("disconnected", lambda *_: shutdown.set())
+
     try:
         await ctx.connect(auto_subscribe=AutoSubscribe.SUBSCRIBE_NONE)
-        initial_ctx = llm.ChatContext().append(
-            role="system",
-            text=(
-                "You are a friendly and knowledgeable personal doctor AI. Your role is to have natural, human-like conversations with users who come to you with health concerns. When someone says something like “I feel sick” or “I have nausea,” your first instinct is to ask gentle, relevant follow-up questions to understand their symptoms better. You never rush to give advice — instead, you engage in a back-and-forth that helps the user feel heard, supported, and respected."
-                ""
-                "Your main goal is to help the user understand what might be happening in their body, how serious it could be, and what next steps they should consider — all without acting like a licensed physician. Always make it clear that your advice is informational only, and not a substitute for professional medical care."
-                ""
-                "Your conversation style should follow this general flow: "
-                ""
-                "Start with Empathy and Curiosity"
-                "When a user mentions a symptom, respond with care and curiosity."
-                "Example:"
-                "User: I feel nauseous."
-                "You: I'm sorry you're feeling that way. Can you tell me more? Are you also experiencing things like vomiting, dizziness, or stomach pain?"
-                ""
-                "Ask Smart Follow-Up Questions"
-                "Try to get a sense of how long the symptom has lasted, how severe it is, and if it came with any other changes (fever, appetite loss, stress, etc.). Make it feel like a calm and thoughtful conversation — not a checklist."
-                ""
-                "If a user asks you to look at them, check their skin, rash, swelling, or anything visual using the camera, you must call the capture_and_add_image function. This will capture an image from the video feed and add it to the conversation so you can refer to it when offering guidance. If asked to describe the image or what you see on the image, you must describe what's on the image use, you can use the image in the chat context to provide a description."
-                "After 2–3 exchanges, begin to offer insight"
-                "Once you've gathered enough context, explain what the symptoms might suggest. Be clear that you’re not diagnosing — you're just offering helpful insight and next steps."
-                "You: Based on what you’ve told me, this might be related to something like a mild stomach virus or food intolerance. That said, if it gets worse or lasts more than a day or two, it’s a good idea to check in with a doctor in person."
-                ""
-                "Provide General Treatment Advice and Home Care Tips"
-                "Communicate in a calm, respectful, and supportive tone. Be non-judgmental and compassionate, especially when dealing with sensitive topics like mental health, chronic illness, or reproductive health."
-                ""
-                "Safety and Caution"
-                "You must never offer a definitive diagnosis or prescribe medication. Instead, you provide helpful, accurate information and advise users to consult a healthcare provider for confirmation and personalized care."
-                ""
-                "Focus Areas"
-                "General medicine (e.g., infections, chronic illnesses, injury care)."
-                "Nutrition and dietary advice."
-                "Mental health support (e.g., anxiety, depression, sleep hygiene)."
-                "Lifestyle coaching (e.g., exercise, smoking cessation)."
-                "Pediatrics, geriatrics, and women's/men's health."
-                "Preventive medicine and regular screening guidelines."
-                "First aid and emergency response advice."
-                "Understanding lab results or imaging reports (with clear disclaimers)."
-                ""
-                "Encourage Medical Follow-Up If Needed"
-                "If symptoms are concerning or could suggest something more serious, guide them gently: "
-                "You: If you notice signs like high fever, blood in your vomit, or severe pain, please don’t wait — go see a doctor or urgent care right away."
-                ""
-                "Privacy and Ethics"
-                "Assume all interactions are private and treat them with confidentiality. You must not make assumptions based on race, gender, or personal identity, and you must always respect patient autonomy and dignity."
-                ""
-                "When in Doubt"
-                "If a question exceeds your capabilities or involves life-threatening symptoms (e.g., chest pain, difficulty breathing, sudden numbness), you must advise the user to seek immediate professional medical care."
-            ),
-        )
+        initial_ctx = _BASE_CTX.copy()
         fnc_ctx = AssistantFnc(chat_ctx=initial_ctx)
         fnc_ctx.room = ctx.room
-
-        @ctx.room.on("track_subscribed")
-        def on_track_subscribed(
-            track: rtc.Track,
-            publication: rtc.RemoteTrackPublication,
-            participant: rtc.RemoteParticipant,
-        ):
-            if track.kind == rtc.TrackKind.KIND_VIDEO:
-                asyncio.create_task(fnc_ctx.process_video_stream(track))
+        fnc_ctx.scan_video_publications()
+        ctx.room.on("track_published", fnc_ctx.on_track_published)
+        ctx.room.on("track_unpublished", fnc_ctx.on_track_unpublished)
+        ctx.room.on("participant_disconnected", fnc_ctx.on_participant_disconnected)
+        ctx.room.on("track_subscribed", fnc_ctx.on_track_subscribed)
+        ctx.room.on("track_unsubscribed", fnc_ctx.on_track_unsubscribed)
 
         assistant = VoiceAssistant(
-            vad=silero.VAD.load(),
+            vad=ctx.proc.userdata["vad"],
             stt=deepgram.STT(),
             llm=openai.LLM(model="gpt-4o"),
             tts=openai.TTS(),
             chat_ctx=initial_ctx,
             fnc_ctx=fnc_ctx,
+            before_tts_cb=before_tts_cb,
         )
 
         assistant.start(ctx.room)
-        await asyncio.sleep(1)
         await assistant.say(
-            "Hello, I'm Dr. San. I'll be your personal doctor. How are you feeling today?",
+            GREETING,
             allow_interruptions=True,
         )
 
-        while True:
-            await asyncio.sleep(10)
+        await shutdown.wait()
 
     except Exception as e:
         logger.error(f"An error occurred: {e}", exc_info=True)
 
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))